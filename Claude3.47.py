@@ -1,28 +1,131 @@
 import os
+import re
 import json
+import asyncio
+import shlex
+import signal
+import codecs
+import shutil
 import subprocess
 import datetime
-from typing import List, Optional
-from dataclasses import dataclass
+import time
+import hashlib
+import itertools
+from contextlib import nullcontext
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import IO, List, Optional
+from dataclasses import dataclass, field
 import anthropic
 from rich.console import Console
 from rich.markdown import Markdown
 from rich.prompt import Prompt
 from rich.panel import Panel
 from rich.text import Text
+from rich.live import Live
 
-@dataclass
+try:
+    import orjson
+except ImportError:  # Fallback auf die Standardbibliothek
+    orjson = None
+
+try:
+    import h2  # noqa: F401 - wird vom HTTP-Client des SDK für HTTP/2 benötigt
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+API_KEY = os.environ.get("ANTHROPIC_API_KEY")  # Einmalig beim Import gelesen
+MAX_TURNS = 20  # Anzahl der Nachrichten, die unverändert an die API gehen
+SUMMARY_TRIGGER = 30  # Ab dieser Anzahl werden ältere Nachrichten zusammengefasst
+API_TIMEOUT = 60.0  # Gesamt-Timeout pro API-Anfrage in Sekunden
+CONNECT_TIMEOUT = 5.0  # Timeout für den Verbindungsaufbau in Sekunden
+RENDER_INTERVAL = 0.1  # Sekunden zwischen zwei Markdown-Aktualisierungen beim Streaming
+OUTPUT_HEAD_CHARS = 8000  # Zeichen vom Anfang der Ausgabe, die an das Modell gehen
+OUTPUT_TAIL_CHARS = 2000  # Zeichen vom Ende der Ausgabe, die an das Modell gehen
+SHELL_METACHARS = set("|&;<>()$`\\\"'*?[]#~=%{}\n")  # Erfordern eine Shell
+
+def json_dumps(obj, sort_keys: bool = False) -> bytes:
+    """Serialisiert kompaktes JSON als UTF-8-Bytes, bevorzugt mit orjson."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, ensure_ascii=False, sort_keys=sort_keys,
+                      separators=(",", ":")).encode("utf-8")
+
+def json_loads(data):
+    """Deserialisiert JSON aus Bytes oder Text, bevorzugt mit orjson."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+@dataclass(slots=True, frozen=True)
 class Message:
     role: str
     content: str
+    ts_ns: int = field(default_factory=time.time_ns)  # Erst beim Schreiben formatiert
+
+class CommandOutput:
+    """Sammelt die Ausgabe eines Befehls: Anfang und Ende bleiben erhalten, die Mitte wird nur gezählt."""
+
+    def __init__(self):
+        self.head: List[str] = []
+        self.head_len = 0
+        self.tail: deque = deque()
+        self.tail_len = 0
+        self.total_len = 0
+
+    def append(self, text: str):
+        """Fügt einen Ausgabeblock hinzu."""
+        self.total_len += len(text)
+        if self.head_len < OUTPUT_HEAD_CHARS:
+            part = text[:OUTPUT_HEAD_CHARS - self.head_len]
+            self.head.append(part)
+            self.head_len += len(part)
+            text = text[len(part):]
+            if not text:
+                return
+        self.tail.append(text)
+        self.tail_len += len(text)
+        # Ältere Blöcke verwerfen, solange das Ende noch vollständig abgedeckt ist
+        while self.tail_len - len(self.tail[0]) >= OUTPUT_TAIL_CHARS:
+            self.tail_len -= len(self.tail.popleft())
+
+    def text(self) -> str:
+        """Liefert die Ausgabe, bei Überlänge mit Kürzungshinweis in der Mitte."""
+        head = "".join(self.head)
+        tail = "".join(self.tail)
+        omitted = self.total_len - self.head_len - OUTPUT_TAIL_CHARS
+        if omitted <= 0:
+            return head + tail
+        return head + f"\n… [{omitted} Zeichen gekürzt] …\n" + tail[-OUTPUT_TAIL_CHARS:]
 
 class CLIAssistant:
+    _CMD_RE = re.compile(r"\[cmd\](.*?)\[/cmd\]", re.DOTALL)
+
     def __init__(self, timeout: int = 30):
         self.console = Console()
-        self.client = anthropic.Client(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+        # Eine langlebige Verbindung für die gesamte Sitzung statt neuem TLS-Handshake pro Anfrage
+        self.client = anthropic.Client(
+            api_key=API_KEY,
+            default_headers={"anthropic-beta": "prompt-caching-2024-07-31"},
+            http_client=anthropic.DefaultHttpxClient(http2=HTTP2_AVAILABLE),
+            timeout=anthropic.Timeout(API_TIMEOUT, connect=CONNECT_TIMEOUT)
+        )
         self.model = "claude-3-5-sonnet-20241022"
         self.conversation_history: List[Message] = []
+        self._message_cache: List[dict] = []  # API-Format der Historie, parallel gepflegt
+        self.tool_log: List[dict] = []  # Ausgeführte Befehle samt Ausgabe
+        self.tool_index = 0  # Befehle davor wurden dem Modell bereits übermittelt
+        self.summary = ""  # Zusammenfassung der älteren Nachrichten
+        self.summary_index = 0  # Nachrichten davor sind in der Zusammenfassung enthalten
         self.timeout = timeout  # Timeout-Wert als Konfigurationsoption
+        self.stream_timeout = 30  # Maximale Wartezeit zwischen zwei Stream-Chunks
+        self.cache_file = Path.home() / ".cache" / "claude_cli" / "responses.json"
+        self.cache_size = 256
+        self._response_cache: Optional[OrderedDict] = None  # Wird erst bei Bedarf geladen
+        self.log_filename = self._new_log_filename()
+        self._log: Optional[IO[bytes]] = None  # Wird beim ersten Eintrag geöffnet
+        self._log_enabled = True  # Nach einem Schreibfehler für die Sitzung abgeschaltet
         
         self.system_prompt = """# System-Prompt: KI-Assistent für Kommandozeilen-Interaktion
 
@@ -44,6 +147,17 @@ Befolgen Sie diese Richtlinien:
 4. Erklärungen:
    - Erläutern Sie kurz die Wirkung jedes Befehls."""
 
+        # Einmal aufgebauter System-Block, der bei jeder Anfrage wiederverwendet wird
+        self._system_block = [{
+            "type": "text",
+            "text": self.system_prompt.strip(),
+            "cache_control": {"type": "ephemeral"}
+        }]
+
+    def request_timeout(self) -> anthropic.Timeout:
+        """Timeout pro Anfrage; ersetzt den Client-Timeout vollständig, daher alle Werte setzen."""
+        return anthropic.Timeout(API_TIMEOUT, connect=CONNECT_TIMEOUT, read=self.stream_timeout)
+
     def print_error(self, message: str):
         """Gibt eine Fehlermeldung sicher aus."""
         error_text = Text()
@@ -57,79 +171,260 @@ Befolgen Sie diese Richtlinien:
         self.console.print(Text(label, style=label_style))
         self.console.print(content)
 
+    def print_cache_usage(self, usage):
+        """Gibt die Token-Nutzung inklusive Prompt-Cache-Treffern aus."""
+        cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+        cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+        self.console.print(Text(
+            f"Tokens: {usage.input_tokens} Eingabe, "
+            f"{cache_read} aus Cache, {cache_write} in Cache geschrieben",
+            style="dim"
+        ))
+
     def add_to_history(self, role: str, content: str):
         """Fügt eine neue Nachricht zur Konversationshistorie hinzu."""
-        self.conversation_history.append(Message(role=role, content=content))
+        msg = Message(role=role, content=content)
+        self.conversation_history.append(msg)
+        self._message_cache.append({"role": role, "content": content})
+        # Erst nach beiden Listen schreiben, damit ein Schreibfehler die Historie nicht halb aktualisiert
+        self._log_message(msg)
+
+    def _log_message(self, msg: Message):
+        """Schreibt eine Nachricht samt formatiertem Zeitstempel ins Sitzungsprotokoll."""
+        self._write_log({
+            "role": msg.role,
+            "content": msg.content,
+            "timestamp": datetime.datetime.fromtimestamp(msg.ts_ns / 1e9).isoformat()
+        })
+
+    def add_to_tool_log(self, command: str, output: str):
+        """Fügt einen ausgeführten Befehl samt Ausgabe zum Befehlsprotokoll hinzu."""
+        entry = {"command": command, "output": output}
+        self.tool_log.append(entry)
+        self._write_log(entry)
+
+    def _write_log(self, entry: dict):
+        """Hängt einen Eintrag an die JSONL-Datei der aktuellen Sitzung an."""
+        if not self._log_enabled:
+            return
+        try:
+            line = json_dumps(entry) + b"\n"
+            if self._log is None:
+                self._log = open(self.log_filename, 'ab', buffering=65536)
+            self._log.write(line)
+        except (OSError, TypeError, ValueError) as e:
+            # Der Chat läuft ohne Protokoll weiter, statt bei jeder Nachricht abzubrechen
+            self._log_enabled = False
+            self.print_error(f"Sitzungsprotokoll {self.log_filename} deaktiviert: {str(e)}")
+
+    def _new_log_filename(self) -> str:
+        """Erzeugt einen noch nicht vorhandenen Dateinamen für das Sitzungsprotokoll."""
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"conversation_{timestamp}.jsonl"
+        counter = 1
+        while os.path.exists(filename):
+            filename = f"conversation_{timestamp}_{counter}.jsonl"
+            counter += 1
+        return filename
+
+    def close_log(self):
+        """Schreibt gepufferte Einträge und schließt die Sitzungsdatei."""
+        if self._log is not None:
+            try:
+                self._log.close()
+            except OSError as e:
+                self.print_error(f"Fehler beim Schließen des Sitzungsprotokolls: {str(e)}")
+            self._log = None
 
     def extract_commands(self, text: str) -> List[str]:
         """Extrahiert alle Befehle zwischen [cmd] und [/cmd] Tags."""
-        commands = []
-        start = 0
+        return [match.group(1).strip() for match in self._CMD_RE.finditer(text)]
+
+    def _command_status(self, message: str) -> str:
+        """Gibt eine Statusmeldung zur Befehlsausführung aus und liefert sie zurück."""
+        self.console.print(Text(message, style="yellow"))
+        return message
+
+    async def _read_stream(self, stream: asyncio.StreamReader, output: CommandOutput):
+        """Liest eine Ausgabe blockweise und zeigt sie sofort an."""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
         while True:
-            try:
-                start = text.index("[cmd]", start) + 5
-                end = text.index("[/cmd]", start)
-                commands.append(text[start:end].strip())
-                start = end + 6
-            except ValueError:
+            data = await stream.read(65536)
+            text = decoder.decode(data, final=not data)
+            if text:
+                output.append(text)
+                self.console.out(text, end="", highlight=False)
+            if not data:
                 break
-        return commands
 
-    def execute_command(self, command: str) -> str:
-        """Führt einen Befehl direkt aus."""
+    async def _kill_process(self, process: asyncio.subprocess.Process):
+        """Beendet den Befehl samt aller Kindprozesse und wartet auf das Ende."""
+        if process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+
+    async def execute_command(self, command: str) -> str:
+        """Führt einen Befehl aus und zeigt die Ausgabe fortlaufend an."""
         if not command:
-            return "Kein gültiger Befehl gefunden."
+            return self._command_status("Kein gültiger Befehl gefunden.")
 
+        process = None
+        tasks = []
         try:
-            result = subprocess.run(
-                command,
-                shell=True,
-                text=True,
-                capture_output=True,
-                timeout=self.timeout  # Verwendung des konfigurierbaren Timeout-Werts
+            # Einfache Programmaufrufe direkt ausführen, nur bei Shell-Syntax /bin/sh starten
+            args = None if not SHELL_METACHARS.isdisjoint(command) else shlex.split(command)
+            use_shell = not args or shutil.which(args[0]) is None  # z.B. Shell-Builtins wie cd
+            options = dict(
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=os.environ,
+                start_new_session=True  # Eigene Prozessgruppe, damit Kindprozesse mit beendet werden
             )
-            
-            output = result.stdout + result.stderr
-            if not output and result.returncode != 0:
-                return f"Befehl fehlgeschlagen mit Exit-Code {result.returncode}"
-            return output if output else "Befehl ausgeführt (keine Ausgabe)"
-            
-        except subprocess.TimeoutExpired:
-            return f"Befehl wurde wegen Zeitüberschreitung ({self.timeout}s) abgebrochen"
+            if use_shell:
+                process = await asyncio.create_subprocess_shell(command, **options)
+            else:
+                process = await asyncio.create_subprocess_exec(*args, **options)
+
+            collected = CommandOutput()
+            tasks = [
+                asyncio.create_task(self._read_stream(process.stdout, collected)),
+                asyncio.create_task(self._read_stream(process.stderr, collected)),
+                asyncio.create_task(process.wait())
+            ]
+            # Verwendung des konfigurierbaren Timeout-Werts
+            done, pending = await asyncio.wait(tasks, timeout=self.timeout)
+            if pending:
+                return self._command_status(
+                    f"Befehl wurde wegen Zeitüberschreitung ({self.timeout}s) abgebrochen"
+                )
+            for task in done:
+                task.result()  # Fehler beim Lesen weiterreichen
+
+            # Große Ausgaben sind bereits gekürzt, damit sie nicht vollständig im nächsten Prompt landen
+            output = collected.text()
+            if output and not output.endswith("\n"):
+                self.console.out("")
+            if not output and process.returncode != 0:
+                return self._command_status(f"Befehl fehlgeschlagen mit Exit-Code {process.returncode}")
+            if not output:
+                return self._command_status("Befehl ausgeführt (keine Ausgabe)")
+            return output
+
         except Exception as e:
-            return f"Fehler bei der Befehlsausführung: {str(e)}"
+            return self._command_status(f"Fehler bei der Befehlsausführung: {str(e)}")
+        finally:
+            # Bei Timeout, Fehler oder Abbruch (Strg+C) keine Leser oder Prozesse zurücklassen
+            for task in tasks:
+                task.cancel()
+            if process is not None:
+                await self._kill_process(process)
+
+    def _load_response_cache(self) -> OrderedDict:
+        """Lädt den Antwort-Cache beim ersten Zugriff von der Festplatte."""
+        if self._response_cache is None:
+            self._response_cache = OrderedDict()
+            try:
+                with open(self.cache_file, 'rb') as f:
+                    self._response_cache.update(json_loads(f.read()))
+            except (OSError, ValueError):
+                pass  # Kein oder beschädigter Cache - mit leerem Cache starten
+        return self._response_cache
+
+    def _save_response_cache(self):
+        """Schreibt den Antwort-Cache auf die Festplatte."""
+        if not self._response_cache:
+            return
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.cache_file, 'wb') as f:
+                f.write(json_dumps(self._response_cache))
+        except OSError as e:
+            self.print_error(f"Fehler beim Speichern des Antwort-Caches: {str(e)}")
+
+    def _cache_key(self, messages: List[dict]) -> str:
+        """Berechnet den Cache-Schlüssel aus Modell, System-Prompt und Historie."""
+        payload = json_dumps([self.model, self.system_prompt, messages], sort_keys=True)
+        return hashlib.blake2b(payload, digest_size=32).hexdigest()
+
+    def _cached_response(self, key: str) -> Optional[str]:
+        """Liefert eine gecachte Antwort und markiert sie als zuletzt verwendet."""
+        cache = self._load_response_cache()
+        response = cache.get(key)
+        if response is not None:
+            cache.move_to_end(key)
+        return response
+
+    def _store_response(self, key: str, response: str):
+        """Legt eine Antwort im LRU-Cache ab."""
+        cache = self._load_response_cache()
+        cache[key] = response
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
 
     def save_conversation(self):
-        """Speichert die aktuelle Konversation in einer JSON-Datei."""
+        """Schreibt gepufferte Nachrichten in die JSONL-Datei der Sitzung."""
         try:
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"conversation_{timestamp}.json"
-            
-            data = {
-                "timestamp": datetime.datetime.now().isoformat(),
-                "conversation": [
-                    {"role": msg.role, "content": msg.content}
-                    for msg in self.conversation_history
-                ]
-            }
-            
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            
-            self.console.print(Text(f"Konversation wurde in {filename} gespeichert.", style="green"))
+            if not self._log_enabled:
+                self.print_error("Sitzungsprotokoll ist nach einem Schreibfehler deaktiviert.")
+            elif self._log is None:
+                self.console.print(Text("Keine neuen Nachrichten zum Speichern.", style="yellow"))
+            else:
+                self._log.flush()
+                self.console.print(Text(f"Konversation wurde in {self.log_filename} gespeichert.", style="green"))
+            self._save_response_cache()
         except Exception as e:
             self.print_error(f"Fehler beim Speichern der Konversation: {str(e)}")
 
+    def _read_conversation_entries(self, filename: str) -> List[dict]:
+        """Liest die Einträge einer JSONL-Datei oder einer Datei im alten JSON-Format."""
+        with open(filename, 'rb', buffering=1 << 16) as f:
+            first = f.readline()
+            if first.strip() == b"{":
+                # Altes Format: eingerücktes Objekt mit "conversation"-Liste
+                data = json_loads(first + f.read())
+                return data["conversation"] + data.get("tool_log", [])
+            return [json_loads(line) for line in itertools.chain([first], f) if line.strip()]
+
     def load_conversation(self, filename: str):
-        """Lädt eine Konversation aus einer JSON-Datei."""
+        """Lädt eine Konversation aus einer JSONL-Datei."""
         try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            self.conversation_history = [
-                Message(role=msg["role"], content=msg["content"])
-                for msg in data["conversation"]
-            ]
+            conversation_history = []
+            message_cache = []
+            tool_log = []
+            for entry in self._read_conversation_entries(filename):
+                if "role" in entry:
+                    if "timestamp" in entry:
+                        timestamp = datetime.datetime.fromisoformat(entry["timestamp"])
+                        ts_ns = int(timestamp.timestamp() * 1e9)
+                    else:
+                        ts_ns = time.time_ns()
+                    conversation_history.append(
+                        Message(entry["role"], entry["content"], ts_ns)
+                    )
+                    message_cache.append({"role": entry["role"], "content": entry["content"]})
+                else:
+                    tool_log.append(entry)
+
+            self.conversation_history = conversation_history
+            self._message_cache = message_cache
+            self.tool_log = tool_log
+            self.tool_index = len(tool_log)
+            self.summary = ""
+            self.summary_index = 0
+
+            # Neue Sitzungsdatei mit dem geladenen Stand beginnen, damit spätere
+            # Speicherungen den wiederhergestellten Kontext enthalten
+            self.close_log()
+            self.log_filename = self._new_log_filename()
+            for msg in conversation_history:
+                self._log_message(msg)
+            for entry in tool_log:
+                self._write_log(entry)
             self.console.print(Text(f"Konversation aus {filename} geladen.", style="green"))
         except Exception as e:
             self.print_error(f"Fehler beim Laden der Konversation: {str(e)}")
@@ -146,24 +441,117 @@ Befolgen Sie diese Richtlinien:
             self.console.print(Text(f"{msg.role}:", style=style))
             self.console.print(Panel(msg.content))
 
+    def summarize_history(self):
+        """Fasst ältere Nachrichten zusammen, damit der Prompt nicht unbegrenzt wächst."""
+        if len(self.conversation_history) - self.summary_index <= SUMMARY_TRIGGER:
+            return
+
+        end = len(self.conversation_history) - MAX_TURNS
+        older = self.conversation_history[self.summary_index:end]
+        dialogue = "\n\n".join(f"{msg.role}: {msg.content}" for msg in older)
+        if self.summary:
+            dialogue = f"Bisherige Zusammenfassung: {self.summary}\n\n{dialogue}"
+
+        try:
+            with self.console.status("Fasse ältere Nachrichten zusammen …"):
+                response = self.client.messages.create(
+                    model=self.model,
+                    max_tokens=400,
+                    messages=[{
+                        "role": "user",
+                        "content": "Fasse den bisherigen Dialog in höchstens 300 Tokens "
+                                   f"zusammen:\n\n{dialogue}"
+                    }],
+                    timeout=self.request_timeout()
+                )
+            self.summary = response.content[0].text
+            self.summary_index = end
+        except Exception as e:
+            # Ohne Zusammenfassung wird weiterhin die volle Historie gesendet
+            self.print_error(f"Fehler beim Zusammenfassen der Historie: {str(e)}")
+
+    def build_history_messages(self) -> List[dict]:
+        """Baut den stabilen Nachrichtenpräfix (Zusammenfassung und Historie) für die API."""
+        messages = []
+        if self.summary:
+            messages.append({"role": "user", "content": f"[Bisheriger Kontext]: {self.summary}"})
+        messages.extend(self._message_cache[self.summary_index:])
+        if messages:
+            # Cache-Breakpoint auf die letzte stabile Nachricht: der Präfix bis
+            # hierhin ist beim nächsten Aufruf byte-identisch. Neues Dict, da die
+            # Einträge aus _message_cache geteilt sind und unverändert bleiben müssen
+            messages[-1] = {
+                "role": messages[-1]["role"],
+                "content": [{
+                    "type": "text",
+                    "text": messages[-1]["content"],
+                    "cache_control": {"type": "ephemeral"}
+                }]
+            }
+        return messages
+
+    def compose_user_message(self, user_input: str) -> str:
+        """Ergänzt die Benutzereingabe um die seit der letzten Anfrage ausgeführten Befehle."""
+        new_entries = self.tool_log[self.tool_index:]
+        self.tool_index = len(self.tool_log)
+        if not new_entries:
+            return user_input
+        # Jede Ausgabe geht genau einmal an das Modell und bleibt danach als Teil
+        # der Benutzernachricht im stabilen, gecachten Präfix der Historie
+        return (user_input + "\n\nAusgeführte Befehle: "
+                + json_dumps(new_entries, sort_keys=True).decode("utf-8"))
+
     def get_response(self, user_input: str) -> str:
         """Holt eine Antwort von der Anthropic API."""
         try:
-            messages = [{"role": msg.role, "content": msg.content} 
-                       for msg in self.conversation_history]
+            messages = self.build_history_messages()
             messages.append({"role": "user", "content": user_input})
 
-            response = self.client.messages.create(
+            key = self._cache_key(messages)
+            cached = self._cached_response(key)
+            if cached is not None:
+                self.print_labeled("Assistant:", Markdown(cached))
+                return cached
+
+            chunks = []
+            self.console.print()  # Leerzeile
+            self.console.print(Text("Assistant:", style="bold blue"))
+            # Markdown nur im Terminal live rendern, bei Umleitung Rohtext ausgeben
+            live = (Live(Markdown(""), console=self.console, auto_refresh=False)
+                    if self.console.is_terminal else None)
+            with self.client.messages.stream(
                 model=self.model,
                 max_tokens=1024,
-                system=self.system_prompt,
-                messages=messages
-            )
+                system=self._system_block,
+                messages=messages,
+                # Lese-Timeout bricht ab, wenn länger als stream_timeout keine Daten kommen
+                timeout=self.request_timeout()
+            ) as stream, live or nullcontext():
+                last_render = time.monotonic()
+                for chunk in stream.text_stream:
+                    now = time.monotonic()
+                    chunks.append(chunk)
+                    if live is None:
+                        self.console.out(chunk, end="", highlight=False)
+                    elif now - last_render > RENDER_INTERVAL:
+                        # Gedrosselt, da jedes Rendern den gesamten Text neu parst
+                        live.update(Markdown("".join(chunks)), refresh=True)
+                        last_render = now
+                if live is None:
+                    self.console.out("")
+                else:
+                    live.update(Markdown("".join(chunks)), refresh=True)
+                usage = stream.get_final_message().usage
 
-            return response.content[0].text
+            self.print_cache_usage(usage)
+            response = "".join(chunks)
+            self._store_response(key, response)
+            return response
         except Exception as e:
             self.console.print_exception()
-            return f"Fehler bei der API-Anfrage: {str(e)}"
+            message = f"Fehler bei der API-Anfrage: {str(e)}"
+            self.print_error(message)
+            return message
 
     def run(self):
         """Hauptschleife des Assistenten."""
@@ -180,6 +568,7 @@ Befolgen Sie diese Richtlinien:
                     continue
 
                 if user_input == "exit":
+                    self.close_log()
                     self.console.print(Text("Auf Wiedersehen!", style="yellow"))
                     break
                 elif user_input == "save":
@@ -192,21 +581,26 @@ Befolgen Sie diese Richtlinien:
                     self.load_conversation(user_input[5:].strip())
                     continue
 
-                # Füge Benutzereingabe zur Historie hinzu
-                self.add_to_history("user", user_input)
-
                 # Hole Antwort von der API
-                response = self.get_response(user_input)
-                self.print_labeled("Assistant:", Markdown(response))
+                user_message = self.compose_user_message(user_input)
+                response = self.get_response(user_message)
+
+                # Füge Benutzereingabe und Antwort zur Historie hinzu
+                self.add_to_history("user", user_message)
                 self.add_to_history("assistant", response)
 
                 # Extrahiere und führe Befehle aus
                 commands = self.extract_commands(response)
                 for command in commands:
                     self.print_labeled("Befehl:", command, "bold yellow")
-                    output = self.execute_command(command)
-                    self.print_labeled("Ausgabe:", output, "bold yellow")
-                    self.add_to_history("user", f"Befehl ausgeführt: {command}\nAusgabe: {output}")
+                    self.console.print()  # Leerzeile
+                    self.console.print(Text("Ausgabe:", style="bold yellow"))
+                    output = asyncio.run(self.execute_command(command))
+                    self.add_to_tool_log(command, output)
+
+                # Erst nach der Antwort zusammenfassen, damit die nächste Anfrage
+                # (und ein möglicher Treffer im Antwort-Cache) nicht darauf warten muss
+                self.summarize_history()
 
             except KeyboardInterrupt:
                 self.console.print(Text("\nBeenden mit 'exit'", style="yellow"))
@@ -216,7 +610,7 @@ Befolgen Sie diese Richtlinien:
 
 def main():
     """Hauptfunktion zum Starten des Assistenten."""
-    if not os.environ.get("ANTHROPIC_API_KEY"):
+    if not API_KEY:
         print("Fehler: ANTHROPIC_API_KEY Umgebungsvariable nicht gesetzt")
         return
 